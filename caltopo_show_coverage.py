@@ -39,8 +39,11 @@ import sys
 import re
 from sys import stdout
 import numpy as np
-import glob
 import time
+from concurrent.futures import ProcessPoolExecutor
+
+# set True to print a line for every tile file and grid processed
+VERBOSE=False
 
 def parse_mbtiles_filename(fn):
 	# given a caltopo-standard mbtiles filename, return a list
@@ -72,6 +75,11 @@ def parse_mbtiles_filename(fn):
 	basename="-".join(p[:-3])
 	return [basename,lat,lon,qy,qx]
 	
+# fast check of a caltopo-standard mbtiles filename, compiled once for scanning
+#  whole directories: <basename>-<lat>-<lon>-<qy><qx>.mbtiles, where lat and lon
+#  are integers and qy,qx are single digits 0-3; groups are basename,lat,lon,qy,qx
+FN_RE=re.compile(r'^(.+)-(\d+)-(\d+)-([0-3])([0-3])\.mbtiles$')
+
 # function for use in 'map' below: return filename base (filename minus any extension)
 def basename_int (filename):
 	return int(os.path.splitext(filename)[0])
@@ -79,10 +87,8 @@ def basename_int (filename):
 # list only directories (not full dir names), modified from
 # http://stackoverflow.com/questions/141291/how-to-list-only-top-level-directories-in-python
 def listsubdirs(folder):  
-	return [
-		d for d in os.listdir(folder)
-			if os.path.isdir(os.path.join(folder,d))
-	]
+	with os.scandir(folder) as it:
+		return [e.name for e in it if e.is_dir()]
 
 # allow specific (pre-normalized) boundaries, so that the same image size and location
 #  can be used for all layers in all nested directories
@@ -105,20 +111,16 @@ b=14.63415
 
 gw=27.7778 # width of a grid, in pixels
 
-# first, build a dictionary of grid height (in pixels) as a function of gy
-phd={}
-for gy in range(-200,1):
-	phd[gy]=(-m*gy)+b
+# the arrays below are indexed by gy+gyoffset, covering gy=-200..0
+gyoffset=200
+
+# first, build an array of grid height (in pixels) as a function of gy
+phd=(-m*np.arange(-gyoffset,1))+b
 	
 # print(str(phd))
  	
-# now build a floating-point dictionary of py as a function of gy
-pyfd={}
-pyfd[-200]=-phd[-200]
-for gy in range(-199,1):
-# 	pyd[gy]=-int(gw*gy*(1+m))
-	pyfd[gy]=pyfd[gy-1]-phd[gy]
-# 	pyd[gy]=int(gw*((-gy)**(1+m)))
+# now build a floating-point array of py as a function of gy
+pyfd=-np.cumsum(phd)
 
 # print(str(pyfd))
 
@@ -138,175 +140,248 @@ v=[1299.5,1275.5,1251.0,1226.7,1202.4,1178.1,1153.7,1128.6,1104.4,1079.0,
 #     462,435,408,381,353,326,299,271,243,216,188,160]
 pydf=dict(zip(k,v))
 
-# now build the integer dictionary for use when drawing the image
-pyd={}
-for gy in k:
-	pyd[gy]=int(pyfd[gy])
-# 	print(str(-pyd[gy]))
+# now build the integer array for use when drawing the image
+#  (astype truncates toward zero, same as int())
+pyd_arr=pyfd.astype(np.int32)
 	
-# print(str(pyd))
+# print(str(pyd_arr))
 
 
-def get_coverage(folder,gxmin=None,gxmax=None,gymin=None,gymax=None):
+# make the coverage images for the mbtiles files directly in folder (no recursion)
+def get_folder_coverage(folder,gxmin=None,gxmax=None,gymin=None,gymax=None):
 	print("Processing "+folder+"...")
-	# basename dictionary: keys = basenames, val = list of gxy coords of files that exist for that basename
+	# basename dictionary: keys = basenames, val = parallel lists [gxlist,gylist]
+	#  of the coords of files that exist for that basename
 	bd={}
 	# 1. read files to populate the lists of xy coords
-	for fn in (i for i in os.listdir(folder) if i.endswith(".mbtiles")):
-		p=parse_mbtiles_filename(fn)
-		if p:
-			[basename,lat,lon,qy,qx]=p
-			if basename not in bd.keys():
-				bd[basename]=[]
-			gx=-(lon*4+qx) # since (negative latitude) increases leftwards
-			gy=-(lat*4+qy) # since image y coordinate increases downwards
-			print("p:"+str(p)+" --> "+str(gx)+":"+str(gy))
-			bd[basename].append([gx,gy])
+	with os.scandir(folder) as it:
+		fnlist=[e.name for e in it if e.is_file() and e.name.endswith(".mbtiles")]
+	for fn in fnlist:
+		mo=FN_RE.match(fn)
+		if not mo:
+			# misses are rare, so let parse_mbtiles_filename print the specific reason
+			if parse_mbtiles_filename(fn):
+				print("PARSE ERROR: Not a caltopo standard filename: "+fn)
+			continue
+		basename=mo.group(1)
+		lat=int(mo.group(2))
+		lon=int(mo.group(3))
+		qy=int(mo.group(4))
+		qx=int(mo.group(5))
+		gx=-(lon*4+qx) # since (negative latitude) increases leftwards
+		gy=-(lat*4+qy) # since image y coordinate increases downwards
+		if VERBOSE:
+			print("p:"+str([basename,lat,lon,qy,qx])+" --> "+str(gx)+":"+str(gy))
+		[gxlist,gylist]=bd.setdefault(basename,[[],[]])
+		gxlist.append(gx)
+		gylist.append(gy)
 	
 	# 2. make an image for each basename (note that any -1m or -2m or other size suffix is part of basename)
 
-	for basename in bd.keys():
-		coords=bd[basename]
-		gxlist=[gxy[0] for gxy in coords]
-		gylist=[gxy[1] for gxy in coords]
-		gxmin=gxmin or min(gxlist)
-		gymin=gymin or min(gylist)
-		gxmax=gxmax or max(gxlist)
-		gymax=gymax or max(gylist)
+	for basename in bd:
+		[gxlist,gylist]=bd[basename]
+		gxarr=np.array(gxlist,dtype=np.int32)
+		gyarr=np.array(gylist,dtype=np.int32)
+		# bounds not given by the caller are taken from the first basename and
+		#  then kept for the rest, so all images in this folder are the same size
+		if gxmin is None:
+			gxmin=int(gxarr.min())
+		if gymin is None:
+			gymin=int(gyarr.min())
+		if gxmax is None:
+			gxmax=int(gxarr.max())
+		if gymax is None:
+			gymax=int(gyarr.max())
+		# tiles outside the bounds would index past the pyd window and the image
+		if gxarr.min()<gxmin or gxarr.max()>gxmax:
+			raise ValueError(folder+": '"+basename+"' tiles span gx "+str(gxarr.min())+".."+str(gxarr.max())+", outside bounds "+str(gxmin)+".."+str(gxmax))
+		if gyarr.min()<gymin or gyarr.max()>gymax:
+			raise ValueError(folder+": '"+basename+"' tiles span gy "+str(gyarr.min())+".."+str(gyarr.max())+", outside bounds "+str(gymin)+".."+str(gymax))
 	# 	xsize=int((xmax-xmin)*1.1)
 	# 	ysize=int((ymax-ymin)*1.1)
 		gxsize=gxmax-gxmin+1
 		gysize=gymax-gymin+1
 		pxsize=int(gxsize*gw)
-		pysize=pyd[gymin]-pyd[gymax+1]+3
-		pyo=pyd[gymax] # vertical offset in pixels
+		# window of pyd_arr covering gy=gymin-1..gymax+1, indexed by gy-pydbase;
+		#  it must lie inside the table (gy=-200..0), or the slice would silently
+		#  wrap or come up short
+		pydbase=gymin-1
+		if pydbase<-gyoffset or gymax+1>0:
+			raise ValueError(folder+": gy bounds "+str(gymin)+".."+str(gymax)+" are outside the grid height table ("+str(1-gyoffset)+"..-1)")
+		pydrow=pyd_arr[pydbase+gyoffset:gymax+2+gyoffset]
+		pysize=pydrow[gymin-pydbase]-pydrow[gymax+1-pydbase]+3
+		pyo=pydrow[gymax-pydbase] # vertical offset in pixels
 		print("creating image: "+str(pxsize)+"x"+str(pysize)+"   pyo="+str(pyo))
-		img=Image.new('L',(pxsize,pysize),'black')
-		pix=img.load()
-		gridcount=0
-# 		print("coords:"+str(coords))
-		for [gx,gy] in coords:
-			ngx=gx-gxmin
-			gridcount+=1
-			llx=int(ngx*gw)
-			urx=int((ngx+1)*gw)-1
-			lly=pysize-(pyd[gy]-pyo+1)
-			ury=pysize-(pyd[gy-1]-pyo)
-			print('grid: '+str(gx)+':'+str(gy)+'   box: ll='+str(llx)+':'+str(lly)+'  ur='+str(urx)+':'+str(ury))
-			for x in range(llx,urx+1):
-				for y in range(ury,lly+1):
-					pix[x,y]=164
-			for x in range(llx,urx+1):
-				pix[x,lly]=128
-				pix[x,ury]=128
-			for y in range(ury,lly+1):
-				pix[llx,y]=128
-				pix[urx,y]=128
-# 			pix[gx-gxmin,gy-gymin]=128
-		img.save(folder+"/"+basename+".bmp")
+		arr=np.zeros((pysize,pxsize),dtype=np.uint8)
+# 		print("coords:"+str(list(zip(gxlist,gylist))))
+		# calculate the pixel box of every grid at once
+		ngx=gxarr-gxmin
+		llxarr=(ngx*gw).astype(np.int32)
+		urxarr=((ngx+1)*gw).astype(np.int32)-1
+		llyarr=pysize-(pydrow[gyarr-pydbase]-pyo+1)
+		uryarr=pysize-(pydrow[gyarr-1-pydbase]-pyo)
+		gridcount=len(gxlist)
+		# every box is a 164 interior with a 128 outline, and there are only a few
+		#  distinct box sizes (widths vary by one pixel from rounding, heights
+		#  vary with latitude), so build each size once and copy it into place
+		templates={}
+		for gx,gy,llx,urx,lly,ury in zip(gxlist,gylist,llxarr.tolist(),urxarr.tolist(),llyarr.tolist(),uryarr.tolist()):
+			if VERBOSE:
+				print('grid: '+str(gx)+':'+str(gy)+'   box: ll='+str(llx)+':'+str(lly)+'  ur='+str(urx)+':'+str(ury))
+			boxsize=(lly-ury+1,urx-llx+1)
+			template=templates.get(boxsize)
+			if template is None:
+				template=np.full(boxsize,128,dtype=np.uint8)
+				template[1:-1,1:-1]=164
+				templates[boxsize]=template
+			arr[ury:lly+1,llx:urx+1]=template
+		Image.fromarray(arr,'L').save(folder+"/"+basename+".bmp")
 		print("  total grids: "+str(gridcount))
-		
-	# 3. recurse subdirectories
-	for d in listsubdirs(folder):
-		get_coverage(folder+"/"+d,-500,-450,-169,-128)
+
+def get_coverage(folder,gxmin=None,gxmax=None,gymin=None,gymax=None):
+	get_folder_coverage(folder,gxmin,gxmax,gymin,gymax)
+	# 3. process all nested subdirectories; each one writes only its own images,
+	#  so they can be done in parallel worker processes
+	subfolders=[]
+	todo=[folder]
+	while todo:
+		parent=todo.pop()
+		for d in listsubdirs(parent):
+			subfolder=os.path.join(parent,d)
+			subfolders.append(subfolder)
+			todo.append(subfolder)
+	with ProcessPoolExecutor() as executor:
+		futures=[executor.submit(get_folder_coverage,d,-500,-450,-169,-128) for d in subfolders]
+		for future in futures:
+			future.result() # re-raise any exception from the worker
+
+# composite colors by nesting level; parse them once here rather than per image
+nestcolor=["red","orange","yellow","green","blue","indigo","violet","black"]
+NEST_RGBA=[]
+for color in nestcolor:
+	rgba=ImageColor.getrgb(color)
+	if len(rgba)<4:
+		rgba=rgba+(255,)
+	NEST_RGBA.append(np.array(rgba,dtype=np.uint8))
+
+# composite image placement and labels
+basemapfile="basemap.png"
+compsizeinbasemap=(1160,1208)
+cox=-37
+coy=64
+compositedir="composite"
+names={
+	't':"Scanned 7.5'",
+	'c':'Contour Lines',
+	'canopy':'Canopy Data',
+	'dem8':'Elevation Data',
+	'f':'FSTopo 2013',
+	'f16a':'FSTopo 2016',
+	'mapbuilder_overlay':'MapBuilder Overlay',
+	'mapbuilder_topo':'MapBuilder Topo',
+	'naip_2014':'NAIP Imagery 2014',
+	'nlcd':'Land Cover Data'}
+fontfile='C:\\Windows\\Fonts\\ARLRDBD.TTF'
+
+# resources that only build_composite needs; they are loaded by
+#  init_composite_worker in each worker process, not on import, so that the
+#  coverage-only path (get_coverage) doesn't need them
+fontBig=None
+fontSmall=None
+basemap=None
+basemaparray=None
+
+# ProcessPoolExecutor initializer for build_composite workers; the basemap is
+#  decoded once per worker rather than once per composite, and is only ever
+#  read, so all composites built by that worker share it
+def init_composite_worker():
+	global fontBig,fontSmall,basemap,basemaparray
+	fontBig=ImageFont.truetype(fontfile,40)
+	fontSmall=ImageFont.truetype(fontfile,20)
+	basemap=Image.open(basemapfile).convert('RGBA')
+	basemaparray=np.asarray(basemap,dtype=np.uint16)
+
+# build and save the composite image for one leafbase from its list of image files;
+#  each call reads and writes only its own files, so build_top_coverage_maps
+#  runs these in parallel worker processes
+def build_composite(leafbase,imgfiles):
+	compositename=os.path.join(compositedir,leafbase+".png")
+	comparray=None
+	print("Generating composite image for '"+leafbase+"'")
+	for imgfile in imgfiles:
+		# path split from https://stackoverflow.com/a/16595356/3577105
+		s=os.path.normpath(imgfile).split(os.path.sep)
+		leafdir=s[-3]
+		nestlevel=len(s)-4
+		print("  nesting level:"+str(nestlevel)+"  leaf dir:"+str(leafdir))
+		# get_coverage writes single-channel ('L') images, so there is no need
+		#  to expand them to RGBA: any nonzero pixel was drawn by get_coverage
+		img=Image.open(imgfile)
+		if img.mode!='L':
+			img=img.convert('L')
+		a=np.asarray(img)
+		if comparray is None:
+			comparray=np.zeros(a.shape+(4,),dtype=np.uint8)
+		comparray[a!=0]=NEST_RGBA[nestlevel-1]
+	composite=Image.fromarray(comparray,'RGBA')
+	
+	# To avoid translucent checkerboards in the resulting image,
+	#  we can't just paste the composite (since paste also pastes
+	#  transparency and applies it to the basemap!); instead, build a
+	#  basemap-sized overlay with the correct offset, which may be positive or
+	#  negative meaning we need to clip both the source and target regions,
+	#  then blend it onto the basemap
+	compsized=np.asarray(composite.resize(compsizeinbasemap))
+	[bw,bh]=basemap.size
+	shiftedarray=np.zeros((bh,bw,4),dtype=np.uint8)
+	shiftedarray[:,:,3]=255 # opaque black background
+	x0=max(cox,0)
+	y0=max(coy,0)
+	x1=min(cox+compsized.shape[1],bw)
+	y1=min(coy+compsized.shape[0],bh)
+	if x1>x0 and y1>y0:
+		shiftedarray[y0:y1,x0:x1]=compsized[y0-coy:y1-coy,x0-cox:x1-cox]
+	# blend in one pass: 50% opacity for all non-blank overlay pixels, same as
+	#  Image.composite with a mask of 128 there and 0 elsewhere
+	alpha=np.where(shiftedarray.any(axis=2),128,0).astype(np.uint16)[:,:,None]
+	blended=(shiftedarray*alpha+basemaparray*(255-alpha)+127)//255
+	finalcomp=Image.fromarray(blended.astype(np.uint8),'RGBA')
+	
+	# add a label
+	draw=ImageDraw.Draw(finalcomp)
+	layername=re.sub("\-\d+m","",leafbase)
+	layertext=names.get(layername,"'"+leafbase+"'")
+# 	print("layername='"+layername+"'   layertext="+layertext)
+	draw.text((560,160),layertext,(40,40,255),font=fontBig)
+	draw.text((580,210),"Filename base: '"+leafbase+"'",(40,40,255),font=fontSmall)
+	draw.text((580,235),time.strftime("%b %#d, %Y"),(40,40,255),font=fontSmall)
+	finalcomp.save(compositename)
 
 # call this function after individual coverage maps have been made in subdirectories
 def build_top_coverage_maps(topdir):
-	# build a list of image files
-	imglist=glob.glob(os.path.join(topdir,"**","*.bmp"),recursive=True)
-# 	print("image files:"+str(imglist))
 	# build dictionary: keys = leaf filenames, vals = list of image files with that leaf name
 	imgdict={}
-	for imgfile in imglist:
-		leafbase=os.path.splitext(os.path.split(imgfile)[-1])[0]
-# 		print(leafbase+" : "+imgfile)
-		if leafbase in imgdict.keys():
-			imgdict[leafbase].append(imgfile)
-		else:
-			imgdict[leafbase]=[imgfile]
+	for dirpath,dirnames,filenames in os.walk(topdir):
+		for fn in filenames:
+			if fn.endswith(".bmp"):
+				imgfile=os.path.join(dirpath,fn)
+				leafbase=os.path.splitext(fn)[0]
+# 				print(leafbase+" : "+imgfile)
+				imgdict.setdefault(leafbase,[]).append(imgfile)
 	
 	# now build a composite for each dictionary entry
-	basemapfile="basemap.png"
-	basemap=Image.open(basemapfile)
-	compsizeinbasemap=(1160,1208)
-	cox=-37
-	coy=64
-	compositedir="composite"
 	if not os.path.isdir(compositedir):
 		os.mkdir(compositedir)
-	nestcolor=["red","orange","yellow","green","blue","indigo","violet","black"]
-	names={
-		't':"Scanned 7.5'",
-		'c':'Contour Lines',
-		'canopy':'Canopy Data',
-		'dem8':'Elevation Data',
-		'f':'FSTopo 2013',
-		'f16a':'FSTopo 2016',
-		'mapbuilder_overlay':'MapBuilder Overlay',
-		'mapbuilder_topo':'MapBuilder Topo',
-		'naip_2014':'NAIP Imagery 2014',
-		'nlcd':'Land Cover Data'}
-# 	for leafbase in ["t","t-2m"]:
-	for leafbase in imgdict.keys():
-		compositename=os.path.join(compositedir,leafbase+".png")
-		comparray=None
-		print("Generating composite image for '"+leafbase+"'")
-		for imgfile in imgdict[leafbase]:
-			# path split from https://stackoverflow.com/a/16595356/3577105
-			s=os.path.normpath(imgfile).split(os.path.sep)
-			leafdir=s[-3]
-			nestlevel=len(s)-4
-			color=nestcolor[nestlevel-1]
-			print("  nesting level:"+str(nestlevel)+"  leaf dir:"+str(leafdir))
-			img=Image.open(imgfile)
-			img=img.convert("RGBA")
-			if comparray is None:
-				comparray=np.zeros((img.size[1],img.size[0],4),dtype=np.int8)
-			pixdata=img.load()
-			rgba=ImageColor.getrgb(color)
-			if len(rgba)<4:
-				rgba=list(rgba)
-				rgba.append(255)
-				rgba=tuple(rgba)
-			for y in range(img.size[1]):
-				for x in range(img.size[0]):
-					if pixdata[x,y]!=(0,0,0,255):
-						comparray[y,x]=rgba
-		composite=Image.fromarray(comparray,'RGBA')
-		
-		# To avoid translucent checkerboards in the resulting image,
-		#  we need to use Image.composite instead of image.paste (since paste
-		#  also pastes transparency and applies it to the basemap!);
-		#  Image.composite does not allow for an offset so we need to create an
-		#  overlay and mask with the correct offset, which may be positive or
-		#  negative meaning we need to create them with .paste instead of .crop
-		compsized=composite.resize(compsizeinbasemap)
-		compsizedshifted=Image.new('RGBA',basemap.size,'black')
-		compsizedshifted.paste(compsized,(cox,coy,cox+compsized.size[0],coy+compsized.size[1]))
-		# make the mask (50% opacity for all non-blank pixels)
-		mask=compsizedshifted.copy()
-		maskdata=mask.load()
-		for y in range(mask.size[1]):
-			for x in range(mask.size[0]):
-				if maskdata[x,y]!=(0,0,0,0):
-					maskdata[x,y]=(255,255,255,128)
-		finalcomp=Image.composite(compsizedshifted,basemap,mask)
-		
-		# add a label
-		draw=ImageDraw.Draw(finalcomp)
-		fontBig=ImageFont.truetype('C:\\Windows\\Fonts\\ARLRDBD.TTF',40)
-		fontSmall=ImageFont.truetype('C:\\Windows\\Fonts\\ARLRDBD.TTF',20)
-		layername=re.sub("\-\d+m","",leafbase)
-		layertext=names.get(layername,"'"+leafbase+"'")
-# 		print("layername='"+layername+"'   layertext="+layertext)
-		draw.text((560,160),layertext,(40,40,255),font=fontBig)
-		draw.text((580,210),"Filename base: '"+leafbase+"'",(40,40,255),font=fontSmall)
-		draw.text((580,235),time.strftime("%b %#d, %Y"),(40,40,255),font=fontSmall)
-		finalcomp.save(compositename)
+# 	imgdict={k:imgdict[k] for k in ["t","t-2m"]}
+	with ProcessPoolExecutor(initializer=init_composite_worker) as executor:
+		# list() waits for all composites and re-raises any worker exception
+		list(executor.map(build_composite,imgdict,imgdict.values()))
 
 		
-topdir=sys.argv[1]	
-# get_coverage(topdir)
-build_top_coverage_maps(topdir)
+# the guard is needed so that worker processes can import this module
+if __name__=='__main__':
+	topdir=sys.argv[1]	
+# 	get_coverage(topdir)
+	build_top_coverage_maps(topdir)
 
-print("\nDone.")
+	print("\nDone.")
@@ -28,7 +28,66 @@ import os
 import sys
 import shutil
 import re
+import errno
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+# errno values meaning copy_file_range can't be used for this pair of files
+#  (e.g. across filesystems on older kernels), rather than a real I/O failure
+copyrangeunsupported={errno.EXDEV,errno.ENOSYS,errno.EINVAL,errno.EOPNOTSUPP,errno.ENOTSUP}
+
+# try to copy all of src to dst with copy_file_range; return True if the whole
+#  file was copied, or False if copy_file_range isn't usable here (it refused
+#  before copying anything, or stopped short by returning 0); any other error
+#  is raised
+def copyrange(src,dst):
+    with open(src,'rb') as s, open(dst,'wb') as d:
+        size=os.fstat(s.fileno()).st_size
+        offset=0
+        while offset<size:
+            try:
+                n=os.copy_file_range(s.fileno(),d.fileno(),size-offset,offset,offset)
+            except OSError as e:
+                if offset==0 and e.errno in copyrangeunsupported:
+                    return False
+                raise
+            if n==0:
+                return False
+            offset+=n
+    return True
+
+# copy the contents of file src to file dst (a full filename, not a directory);
+# - copy_file_range (Linux) lets the filesystem do the copy (even reflink it)
+#     with no user-space buffer
+# - otherwise shutil.copyfile, which already uses sendfile on Linux and its
+#     default-sized buffer elsewhere (kept small since copy_all runs 32 copies
+#     at once); it rewrites dst from the start after a short copyrange
+# like shutil.copy, refuse to copy a file onto itself (e.g. when target is the
+#  parent of a leaf directory), since opening dst would truncate src
+def fastcopy(src,dst):
+    if os.path.exists(dst) and os.path.samefile(src,dst):
+        raise shutil.SameFileError(src+" and "+dst+" are the same file")
+    if hasattr(os,"copy_file_range") and copyrange(src,dst):
+        return
+    shutil.copyfile(src,dst)
+
+# copy one file, then report it; label is printed before the usual
+#  'source --> target directory' line (e.g. to flag non-caltopo files);
+#  the line is built first and written in one call so that lines from
+#  different threads don't interleave
+def copy_one(dst,job):
+    [src,label]=job
+    fastcopy(src,dst)
+    sys.stdout.write(label+src+" --> "+os.path.dirname(dst)+"\n")
+
+# copyjobs is a dictionary: keys = destination filenames, vals = [source filename,label];
+#  keying by destination means a later source for the same destination replaces
+#  the earlier one (as the serial copy did), so no two threads ever write the
+#  same file; the copies are I/O-bound, so overlap them in a thread pool;
+#  target directories must already exist, so that the threads never race on makedirs
+def copy_all(copyjobs):
+    with ThreadPoolExecutor(max_workers=32) as ex:
+        list(ex.map(copy_one,copyjobs.keys(),copyjobs.values()))
 
 [root,dirset]=sys.argv[1:3]
 
@@ -47,16 +106,17 @@ if os.path.isfile(dirset):
     copylist=[line.rstrip('\n') for line in open(dirset)]
 #     print("Copy list:\n"+str(copylist))
     print("Installing from specified copy list...")
+    copyjobs={}
     for c in copylist:
         leaf=os.path.split(c)[0]
         fulltargetdir=os.path.join(target,leaf)
         os.makedirs(fulltargetdir,exist_ok=True)
         c=os.path.join(root,c)
         if os.path.isfile(c):
-            print(c+" --> "+fulltargetdir)
-            shutil.copy(c,fulltargetdir)
+            copyjobs[os.path.join(fulltargetdir,os.path.basename(c))]=[c,""]
         else:
             print("SKIPPING non-existent file "+c+" specified in the list file")
+    copy_all(copyjobs)
     print("\nDone.")
     exit()
 
@@ -83,6 +143,7 @@ else:
 #  - if a given mbtiles file follows the caltopo naming convention,
 #      copy it to <target>/<leafdir_of_file_in_question>
 #    - otherwise, copy to <target>
+copyjobs={}
 for tup in os.walk(basedir):
     [dir,subdirs,files]=tup
     leafdirname=os.path.split(dir)[1]
@@ -92,18 +153,18 @@ for tup in os.walk(basedir):
             if target:
                 td=os.path.join(target,leafdirname)
                 os.makedirs(td,exist_ok=True)
-                print(s+" --> "+td)
-                shutil.copy(s,os.path.join(td,fn))
+                copyjobs[os.path.join(td,fn)]=[s,""]
             else:
                 fnlist.append(os.path.join(leafdirname,fn))
         else:
             if target:
-                print("NON-CALTOPO file: "+s+" --> "+target)
-                shutil.copy(os.path.join(dir,fn),os.path.join(target,fn))
+                copyjobs[os.path.join(target,fn)]=[s,"NON-CALTOPO file: "]
             else:
                 fnlist.append(fn)
 
-if not target:
+if target:
+    copy_all(copyjobs)
+else:
     fnfile=open(dirset+".txt","w")
     for fn in fnlist:
         fnfile.write(fn+"\n")